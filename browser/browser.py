@@ -12,6 +12,7 @@ class Browser:
         self.window = tkinter.Tk()
         self.canvas = tkinter.Canvas(self.window, width=WIDTH, height=HEIGHT, bg="white")
         self.canvas.pack()
+        self.painter = Painter(self.canvas)
         self.window.bind("<Down>", self.handle_down)
         self.window.bind("<Up>", self.handle_up)
         self.window.bind("<Button-1>", self.handle_click)
@@ -74,40 +75,43 @@ class Browser:
             self.draw()
 
     def draw(self):
-        self.canvas.delete("all")
-        self.canvas.create_rectangle(0, 0, WIDTH, CHROME_PX, fill="white", outline="black")
-        self.tabs[self.active_tab].draw(self.canvas)
+        # page content stays on the canvas between frames; the chrome is redrawn on top
+        self.tabs[self.active_tab].draw(self.painter)
+        self.canvas.delete("chrome")
+        self.canvas.create_rectangle(0, 0, WIDTH, CHROME_PX, fill="white", outline="black",
+                                     tags="chrome")
         tab_font = get_font(20, "normal", "roman")
         for i, tab in enumerate(self.tabs):
             name = "Tab {}".format(i)
             x1, x2 = 40 + 80 * i, 120 + 80 * i
-            self.canvas.create_line(x1, 0, x1, 40, fill="black")
-            self.canvas.create_line(x2, 0, x2, 40, fill="black")
-            self.canvas.create_text(x1 + 10, 10, anchor="nw", text=name, font=tab_font, fill="black")
+            self.canvas.create_line(x1, 0, x1, 40, fill="black", tags="chrome")
+            self.canvas.create_line(x2, 0, x2, 40, fill="black", tags="chrome")
+            self.canvas.create_text(x1 + 10, 10, anchor="nw", text=name, font=tab_font,
+                                    fill="black", tags="chrome")
             if i == self.active_tab:
-                self.canvas.create_line(0, 40, x1, 40, fill="black")
-                self.canvas.create_line(x2, 40, WIDTH, 40, fill="black")
+                self.canvas.create_line(0, 40, x1, 40, fill="black", tags="chrome")
+                self.canvas.create_line(x2, 40, WIDTH, 40, fill="black", tags="chrome")
         button_font = get_font(26, "normal", "roman")
         self.canvas.create_rectangle(10, 10, 30, 30,
-                                     outline="black", width=1)
+                                     outline="black", width=1, tags="chrome")
         self.canvas.create_text(11, 0, anchor="nw", text="+",
-                                font=button_font, fill="black")
+                                font=button_font, fill="black", tags="chrome")
         self.canvas.create_rectangle(40, 50, WIDTH - 10, 90,
-                                     outline="black", width=1)
+                                     outline="black", width=1, tags="chrome")
         self.canvas.create_rectangle(10, 50, 35, 90,
-                                     outline="black", width=1)
+                                     outline="black", width=1, tags="chrome")
         self.canvas.create_polygon(
-            15, 70, 30, 55, 30, 85, fill='black')
+            15, 70, 30, 55, 30, 85, fill='black', tags="chrome")
         if self.focus == "address bar":
             self.canvas.create_text(
                 55, 55, anchor='nw', text=self.address_bar,
-                font=button_font, fill="black")
+                font=button_font, fill="black", tags="chrome")
             w = button_font.measure(self.address_bar)
-            self.canvas.create_line(55 + w, 55, 55 + w, 85, fill="black")
+            self.canvas.create_line(55 + w, 55, 55 + w, 85, fill="black", tags="chrome")
         else:
             url = self.tabs[self.active_tab].url
             self.canvas.create_text(55, 55, anchor='nw', text=url,
-                                    font=button_font, fill="black")
+                                    font=button_font, fill="black", tags="chrome")
 
     def load(self, url):
         new_tab = Tab()
@@ -120,24 +124,25 @@ class Browser:
 class Tab:
     def __init__(self):
         self.rules = None
+        self.style_sheet = None
         self.scroll = 0
         self.url = None
         self.document = None
         self.display_list = []
+        self.display_index = None
         self.nodes = None
+        self.index = None
         with open("browser.css") as f:
-            self.default_style_sheet = CSSParser(f.read()).parse()
+            self.default_style_sheet = STYLE_SHEETS.parse("browser.css", f.read())
         self.history = []
         self.focus = None
 
     def click(self, x, y):
         y += self.scroll
-        objs = [obj for obj in tree_to_list(self.document, [])
-                if obj.x <= x < obj.x + obj.width
-                and obj.y <= y < obj.y + obj.height]
-        if not objs:
+        obj = hit_test(self.document, x, y)
+        if not obj:
             return
-        elt = objs[-1].node
+        elt = obj.node
         while elt:
             if isinstance(elt, Text):
                 pass
@@ -146,7 +151,7 @@ class Tab:
                 return self.load(url)
             elif elt.tag == "input":
                 self.focus = elt
-                elt.attributes["value"] = ""
+                elt.set_attribute("value", "")
                 return self.render()
             elif elt.tag == "button":
                 while elt:
@@ -156,9 +161,8 @@ class Tab:
             elt = elt.parent
 
     def submit_form(self, elt):
-        inputs = [node for node in tree_to_list(elt, [])
-                  if isinstance(node, Element)
-                  and node.tag == "input"
+        inputs = [node for node in self.index.form_elements(elt)
+                  if node.tag == "input"
                   and "name" in node.attributes]
 
         body = ""
@@ -180,58 +184,69 @@ class Tab:
 
     def keypress(self, char):
         if self.focus:
-            self.focus.attributes["value"] += char
+            self.focus.set_attribute("value", self.focus.attributes["value"] + char)
             self.render()
 
     def backspace(self):
         if self.focus:
-            self.focus.attributes["value"] = self.focus.attributes["value"][:-1]
+            self.focus.set_attribute("value", self.focus.attributes["value"][:-1])
             self.render()
 
     def load(self, url, body=None):
         self.history.append(url)
         self.url = url
-        headers, body = request(url, body)
-        self.nodes = HTMLParser(body).parse()
-        self.rules = self.default_style_sheet.copy()
+        parser = HTMLParser()
+        headers, body = request(url, body, parser)
+        self.nodes = parser.close()
+        self.index = parser.index
+        sheets = [self.default_style_sheet]
         links = [node.attributes["href"]
-                 for node in tree_to_list(self.nodes, [])
-                 if isinstance(node, Element)
-                 and node.tag == "link"
-                 and "href" in node.attributes
+                 for node in self.index.elements("link")
+                 if "href" in node.attributes
                  and node.attributes.get("rel") == "stylesheet"]
-        for link in links:
-            try:
-                header, body = request(resolve_url(link, url))
-            except:
+        link_urls = [resolve_url(link, url) for link in links]
+        responses = request_all(link_urls)
+        for link_url, response in zip(link_urls, responses):
+            if response is None:
                 continue
-            self.rules.extend(CSSParser(body).parse())
+            header, body = response
+            sheets.append(STYLE_SHEETS.parse(link_url, body))
+        self.style_sheet = STYLE_SHEETS.compile(sheets)
+        self.rules = self.style_sheet.rules
+        self.document = None
         self.render()
 
     def render(self):
-        style(self.nodes, sorted(self.rules, key=cascade_priority))
-        self.document = DocumentLayout(self.nodes)
-        self.document.layout()
+        restyled = []
+        restyle(self.nodes, self.style_sheet, restyled=restyled)
+        if self.document is None:
+            self.document = DocumentLayout(self.nodes)
+        else:
+            for node, changed in restyled:
+                self.document.invalidate(node, changed)
+        self.layout()
+
+    def layout(self):
+        # lay out just past the viewport; scroll_down asks for more
+        self.document.layout(self.scroll + HEIGHT - CHROME_PX + OVERSCAN)
         self.display_list = []
         self.document.paint(self.display_list)
+        self.display_index = DisplayListIndex(self.display_list)
 
-    def draw(self, canvas):
-        for cmd in self.display_list:
-            if cmd.top > self.scroll + HEIGHT - CHROME_PX:
-                continue
-            if cmd.bottom < self.scroll:
-                continue
-            cmd.execute(self.scroll - CHROME_PX, canvas)
+    def draw(self, painter):
+        painter.paint(self.display_index, self.scroll)
+        canvas = painter.canvas
+        canvas.delete("cursor")
         if self.focus:
-            obj = [obj for obj in tree_to_list(self.document, [])
-                   if obj.node == self.focus and \
-                   isinstance(obj, InputLayout)][0]
+            obj = self.document.layouts_for(self.focus, InputLayout)[0]
             text = self.focus.attributes.get("value", "")
             x = obj.x + obj.font.measure(text)
             y = obj.y - self.scroll + CHROME_PX
-            canvas.create_line(x, y, x, y + obj.height)
+            canvas.create_line(x, y, x, y + obj.height, tags="cursor")
 
     def scroll_down(self):
+        if not self.document.covers(self.scroll + SCROLL_STEP + HEIGHT - CHROME_PX):
+            self.layout()  # the page height is an estimate until this finishes
         max_y = self.document.height - (HEIGHT - CHROME_PX)
         self.scroll = min(self.scroll + SCROLL_STEP, max_y)  # do not go past bottom of the page
 
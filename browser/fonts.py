@@ -0,0 +1,72 @@
+import math
+
+
+# Helvetica advance widths in 1/1000 em for the printable ASCII range,
+# taken from the Adobe core font metrics (Arial shares them)
+HELVETICA_WIDTHS = (
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,  # space to /
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,  # 0 to ?
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,  # @ to O
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,  # P to _
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,  # ` to o
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,  # p to ~
+)
+HELVETICA_BOLD_WIDTHS = (
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584,
+)
+FALLBACK_WIDTH = 556  # glyphs outside the table get an average advance
+ASCENT_EM = 0.905
+DESCENT_EM = 0.212
+
+
+def advance_table(widths):
+    return {chr(32 + i): width for i, width in enumerate(widths)}
+
+
+ADVANCES = {
+    "normal": advance_table(HELVETICA_WIDTHS),
+    "bold": advance_table(HELVETICA_BOLD_WIDTHS),
+}
+
+
+class HeadlessFont:
+    # a pure-Python stand-in for tkinter.font.Font, needs no display;
+    # italics use the upright advances like Helvetica-Oblique does
+    def __init__(self, size, weight, slant):
+        self.size = size
+        self.weight = weight
+        self.slant = slant
+        self.pixels = size * 4 / 3  # points at 96 dpi
+        self.advances = ADVANCES.get(weight, ADVANCES["normal"])
+        ascent = math.ceil(ASCENT_EM * self.pixels)
+        descent = math.ceil(DESCENT_EM * self.pixels)
+        self.table = {
+            "ascent": ascent,
+            "descent": descent,
+            "linespace": ascent + descent,
+            "fixed": 0,
+        }
+
+    def measure(self, text):
+        advances = self.advances
+        units = sum([advances.get(c, FALLBACK_WIDTH) for c in text])
+        return round(units * self.pixels / 1000)
+
+    def metrics(self, *options):
+        if len(options) == 1:
+            return self.table[options[0]]
+        return dict(self.table)
+
+    def __str__(self):
+        # a Tk font description, in case the result is drawn on a real canvas
+        description = "Helvetica {}".format(self.size)
+        if self.weight == "bold":
+            description += " bold"
+        if self.slant == "italic":
+            description += " italic"
+        return description
@@ -1,5 +1,16 @@
+import array
+import bisect
+
 from parser import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+VECTOR_BREAK_MIN_WORDS = 64  # shorter runs are broken faster in plain Python
+
 
 def layout_mode(node):
     if isinstance(node, Text):
@@ -16,6 +27,73 @@ def layout_mode(node):
         return "block"
 
 
+def hit_test(obj, x, y):
+    # the deepest box under the point; boxes down to lines stack vertically
+    # inside their parent, so follow the last child under y; only the words
+    # of a line can overflow sideways, so those also need x
+    if not obj.y <= y < obj.y + obj.height:
+        return None
+    found = None
+    while True:
+        if obj.x <= x < obj.x + obj.width:
+            found = obj
+        for child in reversed(obj.children):
+            if child.y <= y < child.y + child.height and \
+                    (not isinstance(obj, LineLayout) or child.x <= x < child.x + child.width):
+                obj = child
+                break
+        else:
+            return found
+
+
+def line_breaks(widths, space, cursor_x, line_x, max_x):
+    # indices of the words that start a new line and the final cursor,
+    # the same as placing the words greedily one by one
+    if numpy is not None and len(widths) >= VECTOR_BREAK_MIN_WORDS \
+            and isinstance(cursor_x, int) and isinstance(space, int):
+        return vector_line_breaks(widths, space, cursor_x, line_x, max_x)
+    breaks = []
+    for i, w in enumerate(widths):
+        if cursor_x + w > max_x:
+            breaks.append(i)
+            cursor_x = line_x
+        cursor_x += w + space
+    return breaks, cursor_x
+
+
+def vector_line_breaks(widths, space, cursor_x, line_x, max_x):
+    widths = numpy.array(widths, dtype=numpy.int64)
+    starts = numpy.zeros(len(widths) + 1, dtype=numpy.int64)
+    numpy.cumsum(widths + space, out=starts[1:])
+    ends = starts[:-1] + widths  # never decreasing, so it can be searched
+    # for a line opened by word j, the first later word ending past the margin;
+    # the word that opens a line is placed even if it is too wide
+    line_ends = numpy.searchsorted(ends, starts[:-1] + (max_x - line_x), side="right")
+    line_ends = numpy.maximum(line_ends, numpy.arange(1, len(widths) + 1)).tolist()
+    breaks = []
+    i = int(numpy.searchsorted(ends, max_x - cursor_x, side="right"))
+    while i < len(widths):
+        breaks.append(i)
+        i = line_ends[i]
+    if breaks:
+        cursor_x = line_x - int(starts[breaks[-1]])
+    return breaks, cursor_x + int(starts[-1])
+
+
+def mark_layout_dirty(obj):
+    obj.dirty = True
+    obj = obj.parent
+    while obj and not obj.descendants_dirty:  # stop where the path is already marked
+        obj.descendants_dirty = True
+        obj = obj.parent
+
+
+def shift(obj, dy):
+    # a clean subtree keeps its line breaks and only moves down or up
+    for obj in preorder(obj):
+        obj.y += dy
+
+
 class InlineLayout:
     def __init__(self, node, parent, previous):
         self.weight = "normal"
@@ -31,21 +109,37 @@ class InlineLayout:
         self.previous = previous
         self.previous_word = None
         self.children = []
+        self.document = parent.document
+        self.document.register(self)
+        self.dirty = True
+        self.descendants_dirty = False
+        self.complete = True  # lines are never left half laid out
 
-    def layout(self):
+    def layout(self, until=None):
         self.width = self.parent.width
         self.x = self.parent.x
 
         if self.previous:
-            self.y = self.previous.y + self.previous.height
+            y = self.previous.y + self.previous.height
         else:
-            self.y = self.parent.y
-
-        self.new_line()
-        self.recurse(self.node)
+            y = self.parent.y
+
+        if not self.dirty and not self.descendants_dirty:
+            if y != self.y:
+                shift(self, y - self.y)
+            return
+        self.y = y
+
+        if self.dirty:
+            for line in self.children:
+                self.document.unregister(line)
+            self.children = []
+            self.new_line()
+            self.recurse(self.node)
         for line in self.children:
             line.layout()
         self.height = sum([line.height for line in self.children])
+        self.dirty = self.descendants_dirty = False
 
     def get_font(self, node):
         weight = node.style["font-weight"]
@@ -69,15 +163,24 @@ class InlineLayout:
 
     def text(self, node):
         font = self.get_font(node)
-        for word in node.text.split():  # remove white spaces
-            w = font.measure(word)  # width
-            if self.cursor_x + w > WIDTH - HSTEP:
+        words = node.text.split()  # remove white spaces
+        widths = font.measure_all(words)
+        space = font.measure(" ")
+        breaks, cursor_x = line_breaks(widths, space, self.cursor_x, self.x, WIDTH - HSTEP)
+        # one run per line, so break indices become the bounds of the runs
+        bounds = [0] + breaks + [len(words)]
+        for i in range(len(bounds) - 1):
+            if i > 0:
                 self.new_line()
+            start, end = bounds[i], bounds[i + 1]
+            if start == end:  # the first word already went to a new line
+                continue
             line = self.children[-1]
-            text = TextLayout(node, word, line, self.previous_word)
-            line.children.append(text)
-            self.previous_word = text
-            self.cursor_x += w + font.measure(" ")
+            run = TextRun(node, words[start:end], widths[start:end], font, space,
+                          line, self.previous_word)
+            line.children.append(run)
+            self.previous_word = run
+        self.cursor_x = cursor_x
 
     def new_line(self):
         self.previous_word = None
@@ -123,15 +226,27 @@ class LineLayout:
         self.parent = parent
         self.previous = previous
         self.children = []
+        self.document = parent.document
+        self.dirty = True
+        self.descendants_dirty = False
+        self.y = 0
 
     def layout(self):
         self.width = self.parent.width
         self.x = self.parent.x
 
         if self.previous:
-            self.y = self.previous.y + self.previous.height
+            y = self.previous.y + self.previous.height
         else:
-            self.y = self.parent.y
+            y = self.parent.y
+
+        if not self.dirty and not self.descendants_dirty:
+            if y != self.y:
+                shift(self, y - self.y)
+            return
+        self.y = y
+        self.dirty = self.descendants_dirty = False
+
         for word in self.children:
             word.layout()
         max_ascent = max([word.font.metrics("ascent") for word in self.children])
@@ -147,23 +262,29 @@ class LineLayout:
             child.paint(display_list)
 
 
-class TextLayout:
-    def __init__(self, node, word, parent, previous):
+class TextRun:
+    # the words of one text node that share a line, painted as one string
+    __slots__ = ("node", "text", "offsets", "font", "parent", "previous",
+                 "x", "y", "width", "height")
+    children = EMPTY_CHILDREN
+
+    def __init__(self, node, words, widths, font, space, parent, previous):
         self.node = node
-        self.word = word
-        self.children = []
+        self.text = " ".join(words)
+        self.offsets = array.array("d")  # x of each word from the start of the run
+        x = 0
+        for w in widths:
+            self.offsets.append(x)
+            x += w + space
+        self.width = x - space
+        self.font = font
         self.parent = parent
         self.previous = previous
+        self.x = 0
+        self.y = 0
+        self.height = 0
 
     def layout(self):
-        weight = self.node.style["font-weight"]
-        style = self.node.style["font-style"]
-        if style == "normal":
-            style = "roman"
-        size = int(float(self.node.style["font-size"][:-2]) * .75)
-        self.font = get_font(size, weight, style)
-        self.width = self.font.measure(self.word)
-
         if self.previous:
             space = self.previous.font.measure(" ")
             self.x = self.previous.x + space + self.previous.width
@@ -172,9 +293,15 @@ class TextLayout:
 
         self.height = self.font.metrics("linespace")
 
+    def word_index(self, x):
+        return max(bisect.bisect_right(self.offsets, x - self.x) - 1, 0)
+
+    def word_at(self, x):
+        return self.text.split(" ")[self.word_index(x)]
+
     def paint(self, display_list):
         color = self.node.style["color"]
-        display_list.append(DrawText(self.x, self.y, self.word, self.font, color))
+        display_list.append(DrawText(self.x, self.y, self.text, self.font, color))
 
 
 class BlockLayout:
@@ -187,29 +314,68 @@ class BlockLayout:
         self.parent = parent
         self.previous = previous
         self.children = []
+        self.document = parent.document
+        self.document.register(self)
+        self.dirty = True
+        self.descendants_dirty = False
+        self.complete = False
 
-    def layout(self):
-        previous = None
+    def layout(self, until=None):
         self.width = self.parent.width
         self.x = self.parent.x
 
         if self.previous:
-            self.y = self.previous.y + self.previous.height
+            y = self.previous.y + self.previous.height
         else:
-            self.y = self.parent.y
-
-        for child in self.node.children:
-            if layout_mode(child) == "inline":
-                next = InlineLayout(child, self, previous)
+            y = self.parent.y
+
+        if not self.dirty and not self.descendants_dirty and self.complete:
+            if y != self.y:
+                shift(self, y - self.y)
+            return
+        self.y = y
+
+        if self.dirty:
+            # keep the boxes of children that are still here in the same mode
+            old_children = {child.node: child for child in self.children}
+            self.children = []
+        else:
+            old_children = {}
+        # children holds boxes for a prefix of the node's children; an
+        # incomplete block stops below `until` and continues on a later call
+        previous = None
+        for i, child in enumerate(self.node.children):
+            if i < len(self.children):
+                next = self.children[i]
+            elif until is not None and previous and previous.y + previous.height > until:
+                break
             else:
-                next = BlockLayout(child, self, previous)
-            self.children.append(next)
+                kind = InlineLayout if layout_mode(child) == "inline" else BlockLayout
+                next = old_children.pop(child, None)
+                if type(next) is kind:
+                    next.previous = previous
+                else:
+                    if next:
+                        self.document.unregister(next)
+                    next = kind(child, self, previous)
+                self.children.append(next)
+            next.layout(until)
             previous = next
+            if not next.complete:
+                break
+        for child in old_children.values():
+            self.document.unregister(child)
 
-        for child in self.children:
-            child.layout()
-
+        self.complete = len(self.children) == len(self.node.children) \
+            and (previous is None or previous.complete)
         self.height = sum([child.height for child in self.children])
+        if not self.complete:
+            # guess the rest from the children laid out completely so far
+            done = [child.height for child in self.children if child.complete]
+            if done:
+                remaining = len(self.node.children) - len(self.children)
+                self.height += remaining * sum(done) / len(done)
+        self.dirty = self.descendants_dirty = False
 
     def paint(self, display_list):
         for child in self.children:
@@ -225,15 +391,72 @@ class DocumentLayout:
         self.node = node
         self.parent = None
         self.children = []
-
-    def layout(self):
-        child = BlockLayout(self.node, self, None)
-        self.children.append(child)
+        self.document = self
+        self.layouts = {}  # DOM node -> layout objects created for it
+        self.dirty = True
+        self.descendants_dirty = False
+        self.complete = False
+        self.until = None  # how far down the last layout went
+
+    def register(self, obj):
+        self.layouts.setdefault(obj.node, []).append(obj)
+
+    def unregister(self, tree):
+        for obj in preorder(tree):
+            objs = self.layouts.get(obj.node)
+            if objs and obj in objs:
+                objs.remove(obj)
+
+    def layouts_for(self, node, kind=None):
+        return [obj for obj in self.layouts.get(node, [])
+                if kind is None or isinstance(obj, kind)]
+
+    def invalidate(self, node, style_changed):
+        inputs = self.layouts_for(node, InputLayout)
+        if inputs:
+            line = inputs[0].parent
+            if style_changed:
+                mark_layout_dirty(line.parent)  # its size may move the line breaks
+            else:
+                mark_layout_dirty(line)  # e.g. a new value: redo just this line box
+            return
+        target = node
+        while target:  # text and inline elements are laid out by an ancestor
+            boxes = self.layouts_for(target, (BlockLayout, InlineLayout))
+            if boxes:
+                break
+            target = target.parent
+        else:
+            return
+        box = boxes[0]
+        kind = InlineLayout if layout_mode(target) == "inline" else BlockLayout
+        if type(box) is not kind and isinstance(box.parent, BlockLayout):
+            # the child list changed the node's layout mode; the parent
+            # block rebuilds it as the right kind of box
+            mark_layout_dirty(box.parent)
+        elif isinstance(box, InlineLayout) or target is not node or not style_changed:
+            mark_layout_dirty(box)
+        # a block's own style does not affect layout; the styles of its
+        # descendants are invalidated one by one
+
+    def layout(self, until=None):
+        # with `until`, lay out only far enough to cover that y position
+        if not self.dirty and not self.descendants_dirty and self.complete:
+            return
+        if not self.children:
+            self.children.append(BlockLayout(self.node, self, None))
+        child = self.children[0]
         self.width = WIDTH - 2 * HSTEP
         self.x = HSTEP
         self.y = VSTEP
-        child.layout()
+        child.layout(until)
+        self.complete = child.complete
+        self.until = until
         self.height = child.height + 2 * VSTEP
+        self.dirty = self.descendants_dirty = False
+
+    def covers(self, y):
+        return self.complete or (self.until is not None and y <= self.until)
 
     def paint(self, display_list):
         self.children[0].paint(display_list)
@@ -252,6 +475,8 @@ class InputLayout:
         self.y = None
         self.width = None
         self.height = None
+        self.document = parent.document
+        self.document.register(self)
 
     def layout(self):
         weight = self.node.style["font-weight"]
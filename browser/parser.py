@@ -1,3 +1,9 @@
+import array
+import hashlib
+import re
+import sys
+import types
+
 from utils import *
 
 INHERITED_PROPERTIES = {
@@ -7,6 +13,12 @@ INHERITED_PROPERTIES = {
     "color": "black",
 }
 
+ANCESTOR_FILTER_SLOTS = 1024
+ANCESTOR_FILTER_HASHES = 2
+ANCESTOR_FILTER_STATS = {"tested": 0, "rejected": 0, "false_positives": 0}
+STYLE_SHEET_CACHE_SIZE = 64
+INLINE_STYLE_CACHE_SIZE = 1024
+
 
 def compute_style(node, property, value):
     if property == "font-size":
@@ -26,68 +38,252 @@ def compute_style(node, property, value):
         return value
 
 
-def style(node, rules):
-    node.style = {}
-
+class AncestorFilter:
+    def __init__(self, slots=ANCESTOR_FILTER_SLOTS, hashes=ANCESTOR_FILTER_HASHES):
+        self.counts = array.array("I", [0]) * slots
+        self.slots = slots
+        self.hashes = hashes
+        self.slots_by_tag = {}
+        self.tested = 0
+        self.rejected = 0
+        self.false_positives = 0
+
+    def slots_for(self, tag):
+        slots = self.slots_by_tag.get(tag)
+        if slots is None:
+            h = hash(tag)
+            slots = tuple((h >> (16 * i)) % self.slots for i in range(self.hashes))
+            self.slots_by_tag[tag] = slots
+        return slots
+
+    def push(self, node):
+        if isinstance(node, Element):
+            for slot in self.slots_for(node.tag):
+                self.counts[slot] += 1
+
+    def pop(self, node):
+        if isinstance(node, Element):
+            for slot in self.slots_for(node.tag):
+                self.counts[slot] -= 1
+
+    def may_contain(self, tag):
+        for slot in self.slots_for(tag):
+            if not self.counts[slot]:
+                return False
+        return True
+
+    def may_match(self, selector):
+        # False means some required ancestor tag is definitely not above us
+        if not selector.ancestor_tags:
+            return True
+        self.tested += 1
+        for tag in selector.ancestor_tags:
+            if not self.may_contain(tag):
+                self.rejected += 1
+                return False
+        return True
+
+
+def style(tree, rules):
+    return restyle(tree, rules, force=True)
+
+
+def restyle(tree, rules, force=False, restyled=None):
+    # only visits dirty nodes, the paths down to them, and the descendants
+    # of nodes whose computed style actually changed; (node, changed) pairs
+    # are appended to restyled for layout invalidation, and nodes whose
+    # child list changed are reported with changed=False
+    if not isinstance(rules, StyleSheet):
+        rules = StyleSheet(rules)
+    ancestors = AncestorFilter()
+    shared = {}  # style sharing cache, only valid for this pass
+    styled = 0
+    stack = [(tree, force)]
+    while stack:
+        node, inherited_changed = stack.pop()
+        if node is None:
+            ancestors.pop(inherited_changed)  # leaving that node's subtree
+            continue
+        changed = False
+        if inherited_changed or node.style_dirty:
+            old_style = node.style if hasattr(node, "style") else None
+            style_node(node, rules, ancestors, shared)
+            styled += 1
+            if old_style is not None and old_style == node.style:
+                node.style = old_style  # keep identity for children sharing it
+            else:
+                changed = True
+            node.style_dirty = False
+            if restyled is not None:
+                restyled.append((node, changed))
+        if node.children_changed:
+            node.children_changed = False
+            if restyled is not None:
+                restyled.append((node, False))  # relayout without a style change
+        if node.descendants_dirty or (changed or force) and node.children:
+            ancestors.push(node)
+            stack.append((None, node))
+            if changed or force:
+                children = node.children
+            else:
+                children = [child for child in node.children
+                            if child.style_dirty or child.descendants_dirty]
+            for child in reversed(children):
+                stack.append((child, changed or force))
+            node.descendants_dirty = False
+    ANCESTOR_FILTER_STATS["tested"] += ancestors.tested
+    ANCESTOR_FILTER_STATS["rejected"] += ancestors.rejected
+    ANCESTOR_FILTER_STATS["false_positives"] += ancestors.false_positives
+    return styled
+
+
+DEFAULT_STYLE = types.MappingProxyType(dict(INHERITED_PROPERTIES))
+
+
+def inherited_style(parent_style, shared):
+    # text nodes only carry the inherited properties of their parent
+    if parent_style is None:
+        return DEFAULT_STYLE
+    if len(parent_style) == len(INHERITED_PROPERTIES):
+        return parent_style  # nothing but inherited properties -> reuse as is
+    key = ("inherited", id(parent_style))
+    entry = shared.get(key)
+    if entry is None or entry[0] is not parent_style:
+        style = types.MappingProxyType({property: parent_style[property]
+                                        for property in INHERITED_PROPERTIES})
+        entry = (parent_style, style)
+        shared[key] = entry
+    return entry[1]
+
+
+def style_node(node, style_sheet, ancestors=None, shared=None):
+    # computed styles are immutable and may be shared between nodes
+    if shared is None:
+        shared = {}
+    parent_style = node.parent.style if node.parent else None
+    if isinstance(node, Text):
+        node.style = inherited_style(parent_style, shared)
+        return
+
+    candidates = style_sheet.candidates(node)
+    matched = []
+    for i, (selector, body) in enumerate(candidates):
+        if ancestors and not ancestors.may_match(selector):
+            continue
+        if not selector.matches(node):
+            if ancestors and selector.ancestor_tags:
+                ancestors.false_positives += 1
+            continue
+        matched.append(i)
+
+    has_inline_style = "style" in node.attributes
+    if not has_inline_style:
+        # same parent style + tag + matched rules -> same computed style
+        key = (id(parent_style), node.tag, tuple(matched))
+        entry = shared.get(key)
+        if entry and entry[0] is parent_style:
+            node.style = entry[1]
+            return
+
+    style = {}
     for property, default_value in INHERITED_PROPERTIES.items():
-        if node.parent:
-            node.style[property] = node.parent.style[property]
+        if parent_style:
+            style[property] = parent_style[property]
         else:
-            node.style[property] = default_value
+            style[property] = default_value
 
-    for selector, body in rules:
-        if not selector.matches(node):
-            continue
+    for i in matched:
+        selector, body = candidates[i]
         for property, value in body.items():
             computed_value = compute_style(node, property, value)
             if not computed_value:
                 continue
-            node.style[property] = computed_value
+            style[property] = computed_value
+
+    if has_inline_style:
+        for property, value in inline_style(node).items():
+            style[property] = value
+
+    node.style = types.MappingProxyType(style)
+    if not has_inline_style:
+        shared[key] = (parent_style, node.style)
 
-    if isinstance(node, Element) and "style" in node.attributes:
-        pairs = CSSParser(node.attributes["style"]).body()
-        for property, value in pairs.items():
-            node.style[property] = value
 
-    for child in node.children:
-        style(child, rules)
+INLINE_STYLES = LRUCache(INLINE_STYLE_CACHE_SIZE)  # style attribute -> declarations
+
+
+def inline_style(node):
+    source = node.attributes["style"]
+    if node.inline_style is None or node.inline_style[0] != source:
+        pairs = INLINE_STYLES.get(source)
+        if pairs is None:
+            pairs = types.MappingProxyType(CSSParser(source).body())
+            INLINE_STYLES.put(source, pairs)
+        node.inline_style = (source, pairs)
+    return node.inline_style[1]
 
 
 class HTMLParser:
-    def __init__(self, body):
+    DELIMITER = re.compile("([<>])")
+    ATTRIBUTE = re.compile(r"""([^\s=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|(\S*)))?""")
+
+    def __init__(self, body=""):
         self.body = body
         self.unfinished = []
+        self.forms = []  # open form elements, innermost last
+        self.index = DocumentIndex()
+        self.text = []  # pieces of the token in progress, carried over between chunks
+        self.in_tag = False
 
     def parse(self):
-        text = ""
-        in_tag = False
-        for char in self.body:
-            if char == "<":
-                in_tag = True
+        self.feed(self.body)
+        return self.close()
+
+    def feed(self, chunk):
+        # split into alternating token, delimiter, token, ..., trailing partial token
+        parts = self.DELIMITER.split(chunk)
+        if self.text and len(parts) > 1:
+            self.text.append(parts[0])
+            parts[0] = "".join(self.text)
+            self.text = []
+        for i in range(1, len(parts), 2):
+            text = parts[i - 1]
+            if parts[i] == "<":
+                self.in_tag = True
                 if text: self.add_text(text)  # if text -> don't add empty strings
-                text = ""
-            elif char == ">":
-                in_tag = False
-                self.add_tag(text)
-                text = ""
             else:
-                text += char
-        if not in_tag and text:
+                self.in_tag = False
+                self.add_tag(text)
+        if parts[-1]:
+            self.text.append(parts[-1])
+
+    def close(self):
+        text = "".join(self.text)
+        if not self.in_tag and text:
             self.add_text(text)
+        self.text = []
         return self.finish()
 
     def get_attributes(self, text):
-        parts = text.split()
+        parts = text.split(None, 1)
         tag = parts[0].lower()
         attributes = {}
-        for attr_pair in parts[1:]:
-            if "=" in attr_pair:
-                key, value = attr_pair.split("=", 1)
-                if len(value) > 2 and value[0] in ["'", "\""]:
-                    value = value[1:-1]  # exclude quotation marks
-                attributes[key.lower()] = value
-            else:
-                attributes[attr_pair.lower()] = ""
+        if len(parts) == 1:
+            pass
+        elif "\"" not in parts[1] and "'" not in parts[1]:
+            for attr_pair in parts[1].split():  # fast path: no quoted values
+                key, _, value = attr_pair.partition("=")
+                attributes[sys.intern(key.lower())] = value
+        else:
+            for match in self.ATTRIBUTE.finditer(parts[1]):
+                key, double, single, bare = match.groups()
+                if double is not None:
+                    value = double
+                elif single is not None:
+                    value = single
+                else:
+                    value = bare or ""
+                attributes[sys.intern(key.lower())] = value
         return tag, attributes
 
     def add_text(self, text):
@@ -103,21 +299,28 @@ class HTMLParser:
     ]
 
     def add_tag(self, tag):
+        if not tag or tag.isspace(): return  # "<>" or a stray ">" right after a tag
         tag, attributes = self.get_attributes(tag)
         if tag.startswith("!"): return
         self.implicit_tags(tag)
         if tag.startswith("/"):
             if len(self.unfinished) == 1: return
             node = self.unfinished.pop()
+            if self.forms and node is self.forms[-1]:
+                self.forms.pop()
             parent = self.unfinished[-1]
             parent.children.append(node)
         elif tag in self.SELF_CLOSING_TAGS:
             parent = self.unfinished[-1]
-            node = Element(tag, attributes, parent)
+            node = Element(tag, attributes, parent, EMPTY_CHILDREN)
+            self.index.add(node, self.forms[-1] if self.forms else None)
             parent.children.append(node)
         else:
             parent = self.unfinished[-1] if self.unfinished else None
             node = Element(tag, attributes, parent)
+            self.index.add(node, self.forms[-1] if self.forms else None)
+            if tag == "form":
+                self.forms.append(node)
             self.unfinished.append(node)
 
     HEAD_TAGS = [
@@ -126,6 +329,7 @@ class HTMLParser:
     ]
 
     def implicit_tags(self, tag):
+        if len(self.unfinished) > 2: return  # html and head/body are already open
         while True:  # more than one tag could have been omitted -> loop
             open_tags = [node.tag for node in self.unfinished]
             if open_tags == [] and tag != "html":
@@ -241,16 +445,24 @@ class TagSelector:
     def __init__(self, tag):
         self.tag = tag
         self.priority = 1
+        self.ancestor_tags = ()
 
     def matches(self, node):
         return isinstance(node, Element) and self.tag == node.tag
 
+    def key_tag(self):
+        return self.tag
+
+    def required_tags(self):
+        return [self.tag]
+
 
 class DescendantSelector:
     def __init__(self, ancestor, descendant):
         self.ancestor = ancestor
         self.descendant = descendant
         self.priority = ancestor.priority + descendant.priority
+        self.ancestor_tags = tuple(sys.intern(tag) for tag in ancestor.required_tags())
 
     def matches(self, node):
         if not self.descendant.matches(node):
@@ -261,7 +473,62 @@ class DescendantSelector:
             node = node.parent
         return False
 
+    def key_tag(self):
+        return self.descendant.key_tag()
+
+    def required_tags(self):
+        return self.ancestor.required_tags() + self.descendant.required_tags()
+
 
 def cascade_priority(rule):
     selector, body = rule
     return selector.priority
+
+
+class StyleSheet:
+    def __init__(self, rules):
+        # sorted once here instead of on every render; sorted() is stable, so
+        # equal priorities keep their source order inside every bucket too
+        self.rules = sorted(rules, key=cascade_priority)
+        self.by_tag = {}  # rightmost tag of the selector -> rules in cascade order
+        for selector, body in self.rules:
+            tag = sys.intern(selector.key_tag())
+            self.by_tag.setdefault(tag, []).append((selector, body))
+
+    def candidates(self, node):
+        if not isinstance(node, Element):
+            return []  # selectors only ever match elements
+        return self.by_tag.get(node.tag, [])
+
+
+class StyleSheetCache:
+    def __init__(self, size=STYLE_SHEET_CACHE_SIZE):
+        self.parsed = LRUCache(size)  # (url, content hash) -> immutable rules
+        self.compiled = LRUCache(size)  # ids of the rule tuples -> (tuples, StyleSheet)
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, url, text):
+        key = (url, hashlib.sha1(text.encode("utf8")).hexdigest())
+        rules = self.parsed.get(key)
+        if rules is None:
+            self.misses += 1
+            rules = tuple((selector, types.MappingProxyType(body))
+                          for selector, body in CSSParser(text).parse())
+            self.parsed.put(key, rules)
+        else:
+            self.hits += 1
+        return rules
+
+    def compile(self, sheets):
+        # the entry keeps its sheets alive, so their ids can't be reused meanwhile
+        key = tuple(id(sheet) for sheet in sheets)
+        entry = self.compiled.get(key)
+        if entry is None:
+            rules = [rule for sheet in sheets for rule in sheet]
+            entry = (tuple(sheets), StyleSheet(rules))
+            self.compiled.put(key, entry)
+        return entry[1]
+
+
+STYLE_SHEETS = StyleSheetCache()
@@ -0,0 +1,56 @@
+def preorder(root):
+    # one child iterator per open level -> memory is O(depth), not O(size)
+    yield root
+    stack = [iter(root.children)]
+    while stack:
+        for node in stack[-1]:
+            yield node
+            if node.children:
+                stack.append(iter(node.children))
+                break
+        else:
+            stack.pop()
+
+
+def postorder(root):
+    stack = [(root, iter(root.children))]
+    while stack:
+        node, children = stack[-1]
+        for child in children:
+            stack.append((child, iter(child.children)))
+            break
+        else:
+            stack.pop()
+            yield node
+
+
+def preorder_with_depth(root):
+    yield root, 0
+    stack = [iter(root.children)]
+    while stack:
+        for node in stack[-1]:
+            yield node, len(stack)
+            if node.children:
+                stack.append(iter(node.children))
+                break
+        else:
+            stack.pop()
+
+
+def ancestors(node, include_self=False):
+    if not include_self:
+        node = node.parent
+    while node:
+        yield node
+        node = node.parent
+
+
+def find_all(root, predicate, order=preorder):
+    return (node for node in order(root) if predicate(node))
+
+
+def find(root, predicate, order=preorder):
+    for node in order(root):
+        if predicate(node):
+            return node
+    return None
@@ -1,7 +1,22 @@
+import array
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
 import socket
 import ssl
+import sys
+import threading
+import time
 import tkinter
 import tkinter.font
+import zlib
+
+from fonts import *
+from traversal import *
 
 
 WIDTH, HEIGHT = 1600, 900
@@ -9,6 +24,8 @@ HSTEP, VSTEP = 13, 18
 SCROLL_STEP = 100
 FONTS = {}
 CHROME_PX = 100
+OVERSCAN = HEIGHT  # content laid out beyond the visible part of a tab
+PAINT_OVERSCAN = 2 * SCROLL_STEP  # content kept on the canvas beyond it
 BLOCK_ELEMENTS = [
     "html", "body", "article", "section", "nav", "aside",
     "h1", "h2", "h3", "h4", "h5", "h6", "hgroup", "header",
@@ -19,41 +36,183 @@ BLOCK_ELEMENTS = [
 ]
 
 
-def request(url, payload=None):
-    scheme, url = url.split("://", 1)
-    assert scheme in ["http", "https", "file"], "Unknown scheme {}".format(scheme)
+IDLE_TIMEOUT = 30
+MAX_IDLE_PER_HOST = 6
+IDEMPOTENT_METHODS = ("GET", "HEAD")  # safe to resend on a fresh connection
+CACHE_MEMORY_BYTES = 8 * 1024 * 1024
+CACHE_DISK_BYTES = 64 * 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+MAX_FETCH_WORKERS = 8
+MAX_CONNECTIONS_PER_HOST = 4
+DNS_TTL = 300
+MEASURE_CACHE_SIZE = 65536
 
-    headers = {}
 
-    if scheme == "file":
-        path = url[1:]
-        file = open(path)
-        body = file.read()
-    else:
-        host, path = url.split("/", 1)
-        path = "/" + path
-        if ":" in host:
-            host, port = host.split(":", 1)
-            port = int(port)
-        elif scheme == "http":
-            port = 80
+class ContentDecoder:
+    def __init__(self, encoding):
+        assert encoding in ["identity", "gzip", "x-gzip", "deflate"], \
+            "Unsupported content-encoding {}".format(encoding)
+        self.encoding = encoding
+        self.started = False
+        if encoding == "identity":
+            self.zlib = None
         else:
-            port = 443
+            self.zlib = zlib.decompressobj(32 + zlib.MAX_WBITS)  # zlib or gzip header
+
+    def decompress(self, data):
+        if not self.zlib:
+            return data
+        try:
+            out = self.zlib.decompress(data)
+        except zlib.error:
+            if self.encoding != "deflate" or self.started:
+                raise
+            # some servers send raw deflate streams without the zlib header
+            self.zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+            out = self.zlib.decompress(data)
+        self.started = True
+        return out
+
+    def flush(self):
+        return self.zlib.flush() if self.zlib else b""
+
 
+class Connector:
+    def __init__(self, dns_ttl=DNS_TTL):
+        self.dns_ttl = dns_ttl
+        self.context = None
+        self.addresses = {}  # (host, port) -> (expiry, sockaddr)
+        self.sessions = {}  # (host, port) -> ssl.SSLSession to resume
+        self.lock = threading.Lock()
+
+    def tls_context(self):
+        with self.lock:
+            if self.context is None:
+                self.context = ssl.create_default_context()  # loads the CA bundle once
+            return self.context
+
+    def resolve(self, host, port):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.addresses.get((host, port))
+            if cached and cached[0] > now:
+                return cached[1]
+        infos = socket.getaddrinfo(host, port, socket.AF_INET,
+                                   socket.SOCK_STREAM, socket.IPPROTO_TCP)
+        address = infos[0][4]
+        with self.lock:
+            self.addresses[(host, port)] = (now + self.dns_ttl, address)
+        return address
+
+    def connect(self, scheme, host, port):
         s = socket.socket(
             family=socket.AF_INET,
             type=socket.SOCK_STREAM,
             proto=socket.IPPROTO_TCP,
         )
-        s.connect((host, port))
+        try:
+            s.connect(self.resolve(host, port))
+        except OSError:
+            s.close()
+            with self.lock:
+                self.addresses.pop((host, port), None)  # maybe a stale address
+            raise
 
         if scheme == "https":
-            ctx = ssl.create_default_context()
-            s = ctx.wrap_socket(s, server_hostname=host)
+            with self.lock:
+                session = self.sessions.get((host, port))
+            s = self.tls_context().wrap_socket(
+                s, server_hostname=host, session=session)
+        return s
+
+    def save_session(self, conn):
+        scheme, host, port = conn.key
+        if scheme != "https" or conn.socket.session is None:
+            return
+        # read after a response so that TLS 1.3 session tickets have arrived
+        with self.lock:
+            self.sessions[(host, port)] = conn.socket.session
+
+    def clear(self):
+        with self.lock:
+            self.addresses = {}
+            self.sessions = {}
+
 
-        method = "POST" if payload else "GET"
-        req = "{} {} HTTP/1.0\r\n".format(method, path)
+CONNECTOR = Connector()
+
+
+class SocketReader:
+    def __init__(self, sock, size=READ_CHUNK_SIZE):
+        self.socket = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # unread data is buffer[start:end]
+        self.end = 0
+
+    def fill(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            pending = bytes(self.view[self.start:self.end])
+            if len(pending) == len(self.buffer):
+                self.buffer = bytearray(2 * len(self.buffer))
+                self.view = memoryview(self.buffer)
+            self.buffer[:len(pending)] = pending
+            self.start, self.end = 0, len(pending)
+        received = self.socket.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def read_until(self, delimiter):
+        scanned = 0
+        while True:
+            i = self.buffer.find(delimiter, self.start + scanned, self.end)
+            if i >= 0:
+                data = self.view[self.start:i + len(delimiter)]
+                self.start = i + len(delimiter)
+                return data
+            scanned = max(0, self.end - self.start - len(delimiter) + 1)
+            if not self.fill():
+                return None
+
+    def read(self, limit):
+        # the returned view is only valid until the next read from this reader
+        if self.start == self.end and not self.fill():
+            return self.view[0:0]
+        size = min(limit, self.end - self.start)
+        data = self.view[self.start:self.start + size]
+        self.start += size
+        return data
+
+
+def content_charset(headers):
+    for param in headers.get("content-type", "").split(";")[1:]:
+        name, _, value = param.partition("=")
+        if name.strip().lower() == "charset":
+            try:
+                return codecs.lookup(value.strip().strip("\"'")).name
+            except LookupError:
+                break
+    return "utf-8"
+
+
+class Connection:
+    def __init__(self, scheme, host, port):
+        self.key = (scheme, host, port)
+        s = CONNECTOR.connect(scheme, host, port)
+        self.socket = s
+        self.reader = SocketReader(s)
+        self.reused = False
+        self.last_used = time.monotonic()
+
+    def request(self, method, path, host, payload=None, extra_headers=None, sink=None):
+        req = "{} {} HTTP/1.1\r\n".format(method, path)
         req += "Host: {}\r\n".format(host)
+        req += "Connection: keep-alive\r\n"
+        req += "Accept-Encoding: gzip, deflate\r\n"
+        for header, value in (extra_headers or {}).items():
+            req += "{}: {}\r\n".format(header, value)
 
         if payload:
             length = len(payload.encode("utf8"))
@@ -62,52 +221,599 @@ def request(url, payload=None):
         else:
             req += "\r\n"
 
-        s.send(req.encode("utf8"))
-        response = s.makefile("r", encoding="utf8", newline="\r\n")
-        status_line = response.readline()
-        version, status, explanation = status_line.split(" ", 2)
-        assert status == "200"  # , "{}: {}".format(status, explanation)
+        self.responded = False
+        self.socket.sendall(req.encode("utf8"))
+        head = self.reader.read_until(b"\r\n\r\n")
+        if head is None:
+            raise ConnectionError("connection closed by peer")
+        lines = str(head, "iso-8859-1").split("\r\n")
+        version, status, explanation = lines[0].split(" ", 2)
+        self.responded = True
 
-        while True:
-            line = response.readline()
-            if line == "\r\n":
-                break
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
             header, value = line.split(":", 1)
             headers[header.lower()] = value.strip()
 
-        assert "transfer-encoding" not in headers
-        assert "content-encoding" not in headers
+        te = headers.get("transfer-encoding", "identity").lower()
+        assert te in ["identity", "chunked"], "Unsupported transfer-encoding {}".format(te)
+        decoder = ContentDecoder(headers.get("content-encoding", "identity").lower())
+
+        self.keep_alive = version == "HTTP/1.1" and \
+            headers.get("connection", "").lower() != "close"
+        if status in ["204", "304"] or method == "HEAD":
+            return status, headers, ""
+
+        if status != "200":
+            sink = None  # only successful responses are streamed to the caller
+        text = codecs.getincrementaldecoder(content_charset(headers))("replace")
+        body = []
+        for data in self.read_body(headers):
+            chunk = text.decode(decoder.decompress(data))
+            if sink and chunk:
+                sink.feed(chunk)
+            body.append(chunk)
+        chunk = text.decode(decoder.flush(), final=True)
+        if sink and chunk:
+            sink.feed(chunk)
+        body.append(chunk)
+        return status, headers, "".join(body)
+
+    def read_exactly(self, size):
+        while size > 0:
+            data = self.reader.read(size)
+            if not data:
+                raise ConnectionError("connection closed before end of body")
+            size -= len(data)
+            yield data
+
+    def read_body(self, headers):
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = self.reader.read_until(b"\r\n")
+                if size_line is None:
+                    raise ConnectionError("connection closed inside chunked body")
+                size = int(bytes(size_line).split(b";", 1)[0], 16)
+                if size == 0:
+                    break
+                yield from self.read_exactly(size)
+                self.reader.read_until(b"\r\n")  # CRLF after every chunk
+            while self.reader.read_until(b"\r\n") not in [b"\r\n", None]:
+                pass  # skip trailers
+        elif "content-length" in headers:
+            yield from self.read_exactly(int(headers["content-length"]))
+        else:
+            self.keep_alive = False  # no length -> body ends with the connection
+            while True:
+                data = self.reader.read(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+
+    def close(self):
+        self.socket.close()
+
+
+class ConnectionPool:
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, max_idle_per_host=MAX_IDLE_PER_HOST):
+        self.idle_timeout = idle_timeout
+        self.max_idle_per_host = max_idle_per_host
+        self.idle = {}  # (scheme, host, port) -> idle connections, most recent last
+        self.lock = threading.RLock()
+
+    def get(self, scheme, host, port):
+        with self.lock:
+            self.expire()
+            idle = self.idle.get((scheme, host, port))
+            if idle:
+                conn = idle.pop()
+                conn.reused = True
+                return conn
+        return Connection(scheme, host, port)
+
+    def release(self, conn):
+        if not conn.keep_alive:
+            conn.close()
+            return
+        conn.last_used = time.monotonic()
+        with self.lock:
+            idle = self.idle.setdefault(conn.key, [])
+            idle.append(conn)
+            while len(idle) > self.max_idle_per_host:
+                idle.pop(0).close()
+
+    def expire(self):
+        deadline = time.monotonic() - self.idle_timeout
+        with self.lock:
+            for key, idle in list(self.idle.items()):
+                for conn in [conn for conn in idle if conn.last_used < deadline]:
+                    idle.remove(conn)
+                    conn.close()
+                if not idle:
+                    del self.idle[key]
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle = {}
+
+
+CONNECTIONS = ConnectionPool()
+
+
+class LRUCache:
+    def __init__(self, max_size, sizeof=lambda value: 1):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.pop(key)
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        self.entries[key] = value
+        self.size += size
+        while self.size > self.max_size:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= self.sizeof(evicted)
+
+    def pop(self, key):
+        if key in self.entries:
+            self.size -= self.sizeof(self.entries.pop(key))
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(","):
+        directive = directive.strip().lower()
+        if not directive:
+            continue
+        if "=" in directive:
+            name, arg = directive.split("=", 1)
+            directives[name.strip()] = arg.strip().strip('"')
+        else:
+            directives[directive] = None
+    return directives
+
+
+class CacheEntry:
+    def __init__(self, url, headers, body, stored=None):
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self.stored = time.time() if stored is None else stored
+
+    def max_age(self):
+        directives = parse_cache_control(self.headers.get("cache-control", ""))
+        if "no-cache" in directives:
+            return 0
+        try:
+            max_age = int(directives.get("max-age") or 0)  # a bare max-age has no value
+            age = int(self.headers.get("age", 0))
+        except (TypeError, ValueError):
+            return 0
+        return max_age - age
+
+    def is_fresh(self):
+        return time.time() - self.stored < self.max_age()
+
+    def validators(self):
+        validators = {}
+        if "etag" in self.headers:
+            validators["If-None-Match"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            validators["If-Modified-Since"] = self.headers["last-modified"]
+        return validators
+
+    def size(self):
+        return len(self.body) + len(self.url)
+
+
+class DiskCache:
+    def __init__(self, directory, max_size=CACHE_DISK_BYTES):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(os.path.getsize(path) for path in self.files())
+
+    def files(self):
+        return [os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith(".json")]
+
+    def path(self, url):
+        name = hashlib.sha256(url.encode("utf8")).hexdigest()
+        return os.path.join(self.directory, name + ".json")
+
+    def get(self, url):
+        path = self.path(url)
+        try:
+            with open(path, encoding="utf8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data["url"] != url:
+            return None
+        os.utime(path)  # mtime doubles as the last access time for eviction
+        return CacheEntry(url, data["headers"], data["body"], data["stored"])
+
+    def put(self, entry):
+        self.pop(entry.url)
+        data = json.dumps({
+            "url": entry.url,
+            "headers": entry.headers,
+            "body": entry.body,
+            "stored": entry.stored,
+        })
+        if len(data) > self.max_size:
+            return
+        path = self.path(entry.url)
+        with open(path, "w", encoding="utf8") as f:
+            f.write(data)
+        self.size += os.path.getsize(path)
+        if self.size > self.max_size:
+            self.evict()
+
+    def pop(self, url):
+        path = self.path(url)
+        if os.path.exists(path):
+            self.size -= os.path.getsize(path)
+            os.remove(path)
+
+    def evict(self):
+        for path in sorted(self.files(), key=os.path.getmtime):
+            if self.size <= self.max_size:
+                break
+            self.size -= os.path.getsize(path)
+            os.remove(path)
+
+
+class HTTPCache:
+    def __init__(self, memory_size=CACHE_MEMORY_BYTES, directory=None,
+                 disk_size=CACHE_DISK_BYTES):
+        self.memory = LRUCache(memory_size, CacheEntry.size)
+        self.disk = DiskCache(directory, disk_size) if directory else None
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.lock = threading.RLock()
+
+    def lookup(self, url):
+        with self.lock:
+            entry = self.memory.get(url)
+            if entry is None and self.disk:
+                entry = self.disk.get(url)
+                if entry:
+                    self.memory.put(url, entry)
+            return entry
+
+    def store(self, url, headers, body):
+        directives = parse_cache_control(headers.get("cache-control", ""))
+        entry = CacheEntry(url, headers, body)
+        if "no-store" in directives or \
+                (entry.max_age() <= 0 and not entry.validators()):
+            self.remove(url)
+            return
+        with self.lock:
+            self.memory.put(url, entry)
+            if self.disk:
+                self.disk.put(entry)
+
+    def refresh(self, entry, headers):
+        headers = {header: value for header, value in headers.items()
+                   if header != "content-length"}
+        entry.headers = dict(entry.headers, **headers)
+        entry.stored = time.time()
+        self.store(entry.url, entry.headers, entry.body)
+
+    def remove(self, url):
+        with self.lock:
+            self.memory.pop(url)
+            if self.disk:
+                self.disk.pop(url)
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "entries": len(self.memory),
+            "memory_bytes": self.memory.size,
+            "disk_bytes": self.disk.size if self.disk else 0,
+        }
+
+
+CACHE = HTTPCache()
+
+
+def fetch(scheme, host, port, method, path, payload=None, extra_headers=None, sink=None):
+    if method in IDEMPOTENT_METHODS:
+        conn = CONNECTIONS.get(scheme, host, port)
+    else:
+        # a stale pooled socket may fail after taking the request, and
+        # sending e.g. a form submission twice is not safe
+        conn = Connection(scheme, host, port)
+    try:
+        try:
+            response = conn.request(method, path, host, payload, extra_headers, sink)
+        except (ConnectionError, ValueError):
+            if method not in IDEMPOTENT_METHODS or not conn.reused or conn.responded:
+                raise
+            # the server dropped an idle connection -> retry on a fresh one
+            conn.close()
+            conn = Connection(scheme, host, port)
+            response = conn.request(method, path, host, payload, extra_headers, sink)
+    except BaseException:
+        conn.close()  # never pool or leak a socket left in an unknown state
+        raise
+    CONNECTOR.save_session(conn)
+    CONNECTIONS.release(conn)
+    return response
+
 
-        body = response.read()
-        s.close()
+def request(url, payload=None, sink=None):
+    full_url = url
+    scheme, url = url.split("://", 1)
+    assert scheme in ["http", "https", "file"], "Unknown scheme {}".format(scheme)
+
+    headers = {}
+
+    if scheme == "file":
+        path = url[1:]
+        body = []
+        with open(path) as file:
+            for chunk in iter(lambda: file.read(READ_CHUNK_SIZE), ""):
+                if sink:
+                    sink.feed(chunk)
+                body.append(chunk)
+        body = "".join(body)
+    else:
+        host, path = url.split("/", 1)
+        path = "/" + path
+        if ":" in host:
+            host, port = host.split(":", 1)
+            port = int(port)
+        elif scheme == "http":
+            port = 80
+        else:
+            port = 443
+
+        if payload:
+            status, headers, body = fetch(scheme, host, port, "POST", path, payload, sink=sink)
+            CACHE.remove(full_url)  # unsafe methods invalidate the cached resource
+            assert status == "200"  # , "{}: {}".format(status, explanation)
+            return headers, body
+
+        entry = CACHE.lookup(full_url)
+        if entry and entry.is_fresh():
+            CACHE.count("hits")
+            if sink:
+                sink.feed(entry.body)
+            return entry.headers, entry.body
+
+        validators = entry.validators() if entry else {}
+        status, headers, body = fetch(scheme, host, port, "GET", path, None, validators, sink)
+        if status == "304" and entry:
+            CACHE.count("revalidations")
+            CACHE.refresh(entry, headers)
+            if sink:
+                sink.feed(entry.body)
+            return entry.headers, entry.body
+
+        CACHE.count("misses")
+        assert status == "200"  # , "{}: {}".format(status, explanation)
+        CACHE.store(full_url, headers, body)
 
     return headers, body
 
 
+def host_of(url):
+    scheme, url = url.split("://", 1)
+    return scheme, url.split("/", 1)[0]
+
+
+def request_all(urls, max_per_host=MAX_CONNECTIONS_PER_HOST):
+    limits = {host_of(url): threading.Semaphore(max_per_host) for url in urls}
+
+    def fetch_one(url):
+        with limits[host_of(url)]:
+            try:
+                return request(url)
+            except Exception:
+                return None  # failed subresources are skipped by the caller
+
+    if not urls:
+        return []
+    workers = min(len(urls), MAX_FETCH_WORKERS)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(fetch_one, urls))  # results stay in input order
+
+
+MEASURE_CACHE = LRUCache(MEASURE_CACHE_SIZE)  # ((backend, size, weight, slant), text) -> width
+MEASURE_STATS = {"hits": 0, "misses": 0}
+FONT_METRICS = {}  # (backend, size, weight, slant) -> ascent, descent, linespace and fixed
+
+
+class MeasuredFont:
+    # answers measure() and metrics() from caches instead of asking Tk
+    def __init__(self, key, font):
+        self.key = key
+        self.font = font
+        # kept on the font too, so it outlives a switch of backend
+        self.table = FONT_METRICS[key] = font.metrics()
+
+    def measure(self, text):
+        width = MEASURE_CACHE.get((self.key, text))
+        if width is None:
+            MEASURE_STATS["misses"] += 1
+            width = self.font.measure(text)
+            MEASURE_CACHE.put((self.key, text), width)
+        else:
+            MEASURE_STATS["hits"] += 1
+        return width
+
+    def measure_all(self, words):
+        # measure() for a whole text node, with the cache lookups inlined
+        entries = MEASURE_CACHE.entries
+        widths = []
+        for word in words:
+            key = (self.key, word)
+            width = entries.get(key)
+            if width is None:
+                width = self.measure(word)
+            else:
+                entries.move_to_end(key)
+                MEASURE_STATS["hits"] += 1
+            widths.append(width)
+        return widths
+
+    def metrics(self, *options):
+        if len(options) == 1:
+            return self.table[options[0]]
+        return dict(self.table)
+
+    def __str__(self):
+        return str(self.font)  # Tk still draws with the real font
+
+
+def measure_stats():
+    lookups = MEASURE_STATS["hits"] + MEASURE_STATS["misses"]
+    return {
+        "hits": MEASURE_STATS["hits"],
+        "misses": MEASURE_STATS["misses"],
+        "hit_rate": MEASURE_STATS["hits"] / lookups if lookups else 0.0,
+        "entries": len(MEASURE_CACHE),
+        "fonts": len(FONT_METRICS),
+    }
+
+
+def tk_font(size, weight, slant):
+    return tkinter.font.Font(size=size, weight=weight, slant=slant)
+
+
+FONT_BACKENDS = {
+    "tk": tk_font,
+    "headless": HeadlessFont,  # layout without a display, e.g. in worker processes
+}
+
+
+def check_font_backend(name):
+    if name not in FONT_BACKENDS:
+        raise ValueError("unknown font backend: " + name)
+    return name
+
+
+FONT_BACKEND = check_font_backend(os.environ.get("BROWSER_FONT_BACKEND", "tk"))
+
+
+def set_font_backend(name):
+    # fonts already handed out keep measuring with the old backend, and so
+    # do the layouts holding them; build a new DocumentLayout to switch those
+    # (font keys name their backend, so the caches need no clearing)
+    global FONT_BACKEND
+    FONT_BACKEND = check_font_backend(name)
+
+
 def get_font(size, weight, slant):
-    key = (size, weight, slant)
+    key = (FONT_BACKEND, size, weight, slant)
     if key not in FONTS:
-        font = tkinter.font.Font(size=size, weight=weight, slant=slant)
-        FONTS[key] = font
+        font = FONT_BACKENDS[FONT_BACKEND](size, weight, slant)
+        FONTS[key] = MeasuredFont(key, font)
     return FONTS[key]
 
 
+EMPTY_CHILDREN = ()  # shared by all leaves, appending to it is an error
+
+
+def mark_style_dirty(node):
+    node.style_dirty = True
+    node = node.parent
+    while node and not node.descendants_dirty:  # stop where the path is already marked
+        node.descendants_dirty = True
+        node = node.parent
+
+
+def mark_children_changed(node):
+    # the child list changed: layout has to redo the node, its style stays
+    node.children_changed = True
+    while node and not node.descendants_dirty:  # the restyle walk reports it
+        node.descendants_dirty = True
+        node = node.parent
+
+
 class Text:
+    __slots__ = ("text", "parent", "style", "style_dirty")
+    children = EMPTY_CHILDREN  # text object will never have children
+    descendants_dirty = False
+    children_changed = False
+
     def __init__(self, text, parent):
         self.text = text
-        self.children = []  # text object will never have children
         self.parent = parent
+        self.style_dirty = True
 
     def __repr__(self):
         return repr(self.text)
 
 
 class Element:
-    def __init__(self, tag, attributes, parent):
-        self.tag = tag
+    __slots__ = ("tag", "attributes", "children", "parent", "style", "inline_style",
+                 "style_dirty", "descendants_dirty", "children_changed")
+
+    def __init__(self, tag, attributes, parent, children=None):
+        self.tag = sys.intern(tag)
         self.attributes = attributes
-        self.children = []
+        self.children = [] if children is None else children
         self.parent = parent
+        self.inline_style = None  # (style attribute it was parsed from, declarations)
+        self.style_dirty = True
+        self.descendants_dirty = True
+        self.children_changed = False
+
+    def set_attribute(self, name, value):
+        self.attributes[name] = value
+        mark_style_dirty(self)
+
+    def append_child(self, child, index=None):
+        child.parent = self
+        self.children.append(child)
+        mark_style_dirty(child)
+        mark_children_changed(self)
+        if index:
+            index.add_subtree(child)
+
+    def remove_child(self, child, index=None):
+        if index:
+            index.remove_subtree(child)  # needs the child still in the tree
+        self.children.remove(child)
+        child.parent = None
+        mark_children_changed(self)
 
     def __repr__(self):
         return "<" + self.tag + ">"
@@ -122,13 +828,14 @@ class DrawText:
         self.color = color
         self.bottom = y1 + font.metrics("linespace")
 
-    def execute(self, scroll, canvas):
-        canvas.create_text(
+    def execute(self, scroll, canvas, tags=()):
+        return canvas.create_text(
             self.left, self.top - scroll,
             text=self.text,
             font=self.font,
             fill=self.color,
             anchor='nw',
+            tags=tags,
         )
 
     def __repr__(self):
@@ -143,25 +850,217 @@ class DrawRect:
         self.right = x2
         self.color = color
 
-    def execute(self, scroll, canvas):
-        canvas.create_rectangle(
+    def execute(self, scroll, canvas, tags=()):
+        return canvas.create_rectangle(
             self.left, self.top - scroll,
             self.right, self.bottom - scroll,
             width=0,
             fill=self.color,
+            tags=tags,
         )
 
 
+class DisplayListIndex:
+    # the commands sorted by top, with a running max of their bottoms, so a
+    # y range query skips whatever lies entirely above or below it; commands
+    # taller than a screen would hold that max up and are checked separately
+    def __init__(self, display_list):
+        self.display_list = display_list
+        self.tall = [i for i, cmd in enumerate(display_list)
+                     if cmd.bottom - cmd.top > HEIGHT]
+        tall = set(self.tall)
+        self.order = sorted([i for i in range(len(display_list)) if i not in tall],
+                            key=lambda i: display_list[i].top)  # stable
+        self.tops = [display_list[i].top for i in self.order]
+        self.max_bottoms = []
+        bottom = float("-inf")
+        for i in self.order:
+            bottom = max(bottom, display_list[i].bottom)
+            self.max_bottoms.append(bottom)
+
+    def query(self, y1, y2):
+        # display list indices of the commands overlapping y1..y2, in paint order
+        start = bisect.bisect_left(self.max_bottoms, y1)
+        end = bisect.bisect_right(self.tops, y2)
+        display_list = self.display_list
+        found = [i for i in self.order[start:end] if display_list[i].bottom >= y1]
+        found += [i for i in self.tall
+                  if display_list[i].top <= y2 and display_list[i].bottom >= y1]
+        return sorted(found)
+
+
+class Painter:
+    # keeps the canvas items of the commands near the viewport between frames;
+    # scrolling moves them and only creates or deletes those at the edges
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.display_list = None
+        self.scroll = 0
+        self.items = {}  # display list index -> canvas item id
+        self.indices = []  # sorted keys of items
+
+    def reset(self):
+        self.canvas.delete("content")
+        self.display_list = None
+        self.items = {}
+        self.indices = []
+
+    def paint(self, index, scroll):
+        display_list = index.display_list
+        if display_list is not self.display_list:  # a new render or another tab
+            self.reset()
+            self.display_list = display_list
+        elif scroll != self.scroll:
+            self.canvas.move("content", 0, self.scroll - scroll)
+        self.scroll = scroll
+
+        wanted = index.query(scroll - PAINT_OVERSCAN,
+                             scroll + HEIGHT - CHROME_PX + PAINT_OVERSCAN)
+        wanted_set = set(wanted)
+        for i in self.indices:
+            if i not in wanted_set:
+                self.canvas.delete(self.items.pop(i))
+        self.indices = [i for i in self.indices if i in self.items]
+
+        for i in wanted:
+            if i in self.items:
+                continue
+            item = display_list[i].execute(scroll - CHROME_PX, self.canvas, "content")
+            position = bisect.bisect(self.indices, i)
+            if position < len(self.indices):
+                # keep the stacking order of the display list
+                self.canvas.tag_lower(item, self.items[self.indices[position]])
+            self.indices.insert(position, i)
+            self.items[i] = item
+
+
+FORM_ASSOCIATED_ELEMENTS = [
+    "button", "fieldset", "input", "object", "output", "select", "textarea",
+]
+
+
+def tree_position(node):
+    # child indices from the root down; these compare in document order
+    path = []
+    while node.parent:
+        path.append(node.parent.children.index(node))
+        node = node.parent
+    path.reverse()
+    return path
+
+
+def insert_in_tree_order(nodes, node):
+    position = tree_position(node)
+    lo, hi = 0, len(nodes)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if tree_position(nodes[mid]) < position:
+            lo = mid + 1
+        else:
+            hi = mid
+    nodes.insert(lo, node)
+
+
+class DocumentIndex:
+    def __init__(self):
+        self.by_tag = {}  # tag -> elements in document order
+        self.by_id = {}
+        self.by_form = {}  # form element -> the controls it owns
+
+    def add(self, node, form=None):
+        self.by_tag.setdefault(node.tag, []).append(node)
+        if "id" in node.attributes:
+            self.by_id.setdefault(node.attributes["id"], node)  # first one wins
+        if form and node.tag in FORM_ASSOCIATED_ELEMENTS:
+            self.by_form.setdefault(form, []).append(node)
+
+    def add_subtree(self, root):
+        # elements added after parsing go to their place in document order;
+        # a control belongs to its nearest form ancestor, as while parsing
+        for node in preorder(root):
+            if isinstance(node, Text):
+                continue
+            insert_in_tree_order(self.by_tag.setdefault(node.tag, []), node)
+            if "id" in node.attributes:
+                id = node.attributes["id"]
+                first = self.by_id.get(id)
+                if first is None or tree_position(node) < tree_position(first):
+                    self.by_id[id] = node
+            if node.tag in FORM_ASSOCIATED_ELEMENTS:
+                form = find(node, lambda a: a.tag == "form", ancestors)
+                if form:
+                    insert_in_tree_order(self.by_form.setdefault(form, []), node)
+
+    def remove_subtree(self, root):
+        removed = [node for node in preorder(root) if not isinstance(node, Text)]
+        for node in removed:
+            self.by_tag[node.tag].remove(node)
+            self.by_form.pop(node, None)
+            for controls in self.by_form.values():
+                if node in controls:
+                    controls.remove(node)
+        removed = set(removed)
+        for id, node in list(self.by_id.items()):
+            if node in removed:
+                del self.by_id[id]
+                # the next element with that id, if any, takes over
+                others = [other for nodes in self.by_tag.values() for other in nodes
+                          if other.attributes.get("id") == id and other not in removed]
+                if others:
+                    self.by_id[id] = min(others, key=tree_position)
+
+    def elements(self, tag):
+        return self.by_tag.get(tag, [])
+
+    def element_by_id(self, id):
+        return self.by_id.get(id)
+
+    def form_elements(self, form):
+        return self.by_form.get(form, [])
+
+
+class NodeTable:
+    def __init__(self, root):
+        # pre-order node list plus parallel index arrays, -1 means "none"
+        self.nodes = []
+        self.parent = array.array("i")
+        self.first_child = array.array("i")
+        self.next_sibling = array.array("i")
+        stack = [(root, -1)]
+        previous_sibling = {}  # parent index -> index of its last child so far
+        while stack:
+            node, parent = stack.pop()
+            index = len(self.nodes)
+            self.nodes.append(node)
+            self.parent.append(parent)
+            self.first_child.append(-1)
+            self.next_sibling.append(-1)
+            if parent >= 0:
+                if parent in previous_sibling:
+                    self.next_sibling[previous_sibling[parent]] = index
+                else:
+                    self.first_child[parent] = index
+                previous_sibling[parent] = index
+            for child in reversed(node.children):
+                stack.append((child, index))
+
+    def children(self, index):
+        child = self.first_child[index]
+        while child >= 0:
+            yield child
+            child = self.next_sibling[child]
+
+    def __len__(self):
+        return len(self.nodes)
+
+
 def print_tree(node, indent=0):
-    print(" " * indent, node)
-    for child in node.children:
-        print_tree(child, indent + 2)
+    for node, depth in preorder_with_depth(node):
+        print(" " * (indent + 2 * depth), node)
 
 
 def tree_to_list(tree, list):
-    list.append(tree)
-    for child in tree.children:
-        tree_to_list(child, list)
+    list.extend(preorder(tree))
     return list
 
 